@@ -1,46 +1,111 @@
-from passlib.context import CryptContext
-from datetime import datetime, timedelta
+from cachetools import TLRUCache
+from datetime import datetime, timedelta, timezone
+import asyncio
+import base64
+import bcrypt
+import hashlib
+import hmac
 import secrets
 import jwt
+import orjson
 import os
+import time
 
 # Настройки для хэширования паролей
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Стоимость bcrypt: каждый +1 удваивает время. 10 даёт ~50-100 мс на хэш
+# вместо сотен миллисекунд при значении по умолчанию 12
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
 
 # Секретный ключ для JWT
-SECRET_KEY = os.getenv("JWT_SECRET", "your-secret-key-change-in-production")
+SECRET_KEY = os.getenv("JWT_SECRET", "your-super-secret-jwt-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 30
 
+# Ключ подписи в байтах и заголовок токена не меняются - готовим их один раз
+SIGNING_KEY = SECRET_KEY.encode()
+
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+JWT_HEADER = _b64url(orjson.dumps({"alg": ALGORITHM, "typ": "JWT"}))
+
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
 
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+
+# bcrypt занимает десятки миллисекунд CPU, поэтому в async-коде
+# выполняем его в отдельном потоке, чтобы не блокировать event loop
+async def averify_password(plain_password, hashed_password):
+    return await asyncio.to_thread(verify_password, plain_password, hashed_password)
+
+
+async def aget_password_hash(password):
+    return await asyncio.to_thread(get_password_hash, password)
 
 
+# Собираем HS256-токен напрямую: hmac/hashlib работают через OpenSSL,
+# а обёртки PyJWT (проверка ключа, сериализация заголовка) нам не нужны
 def create_access_token(user_id: int, username: str):
     expires_delta = timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
-    expire = datetime.utcnow() + expires_delta
+    expire = datetime.now(timezone.utc) + expires_delta
 
     to_encode = {
         "sub": str(user_id),
         "username": username,
-        "exp": expire
+        "exp": int(expire.timestamp()),
+        "type": "access"
     }
 
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    signing_input = JWT_HEADER + b"." + _b64url(orjson.dumps(to_encode))
+    signature = hmac.new(SIGNING_KEY, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + _b64url(signature)).decode()
+
+
+# Кэш проверенных токенов. Ключ - blake2b-хэш токена, сам токен в памяти не храним.
+# Запись живёт TOKEN_CACHE_TTL секунд, но не дольше срока действия токена (exp)
+TOKEN_CACHE_TTL = 5
+# Claims, без которых токен считается невалидным (проверяются в jwt.decode)
+REQUIRED_CLAIMS = ["exp", "sub", "username", "type"]
+
+
+def _token_ttu(key, payload, now):
+    exp = payload.get("exp")
+    if exp is None:
+        return now + TOKEN_CACHE_TTL
+    return min(now + TOKEN_CACHE_TTL, exp)
+
+
+_token_cache = TLRUCache(maxsize=10_000, ttu=_token_ttu, timer=time.time)
 
 
 def verify_token(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except jwt.PyJWTError:
-        return None
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    payload = _token_cache.get(key)
+
+    if payload is None:
+        try:
+            payload = jwt.decode(
+                token,
+                SIGNING_KEY,
+                algorithms=[ALGORITHM],
+                options={"require": REQUIRED_CLAIMS}
+            )
+        except jwt.PyJWTError:
+            # Невалидные токены не кэшируем
+            return None
+        # Принимаем только access-токены: вызывающему коду проверять тип не нужно
+        if payload["type"] != "access":
+            return None
+        _token_cache[key] = payload
+
+    return dict(payload)
 
 
 def generate_session_token():
@@ -1,19 +1,58 @@
 import os
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 
 # Используем переменную окружения или fallback на SQLite
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./messenger.db")
 
-# Для PostgreSQL нужно заменить драйвер
+# Логирование SQL только по явному запросу: echo пропускает каждый запрос через logging
+SQL_ECHO = os.getenv("SQL_ECHO", "").lower() in ("1", "true", "yes")
+
+# Для PostgreSQL принудительно используем асинхронный драйвер asyncpg
+# (Render отдаёт строку вида postgres://..., без указания драйвера)
+for prefix in ("postgres://", "postgresql://", "postgresql+psycopg2://", "postgresql+psycopg://"):
+    if DATABASE_URL.startswith(prefix):
+        DATABASE_URL = "postgresql+asyncpg://" + DATABASE_URL[len(prefix):]
+        break
+
+engine_options = {}
+
 if DATABASE_URL.startswith("postgresql"):
-    DATABASE_URL = DATABASE_URL.replace("postgresql", "postgresql+asyncpg")
+    # Кэш подготовленных выражений на соединение: горячие запросы WebSocket
+    # не парсятся и не планируются заново. 0 отключает (нужно за pgbouncer)
+    statement_cache_size = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+
+    # Размер пула: pool_size ≈ воркеры × одновременные запросы на один запрос,
+    # max_overflow покрывает пики, pre_ping отсекает соединения, закрытые сервером
+    engine_options.update(
+        pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        connect_args={
+            "prepared_statement_cache_size": statement_cache_size,
+            "statement_cache_size": statement_cache_size,
+        },
+    )
 
 engine = create_async_engine(
     DATABASE_URL,
-    echo=True,
-    future=True
+    echo=SQL_ECHO,
+    future=True,
+    **engine_options
 )
 
+# Для файловой SQLite aiosqlite и так работает через AsyncAdaptedQueuePool
+# (соединения переиспользуются), поэтому настраиваем только сами соединения
+if DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL: чтения не блокируют запись, NORMAL: без fsync на каждый коммит
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
 AsyncSessionLocal = async_sessionmaker(
     bind=engine,
     class_=AsyncSession,
@@ -23,4 +62,4 @@ AsyncSessionLocal = async_sessionmaker(
 
 async def get_db():
     async with AsyncSessionLocal() as session:
-        yield session
\ No newline at end of file
+        yield session
@@ -0,0 +1,82 @@
+import base64
+import binascii
+import os
+import struct
+import time
+from typing import Union
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# Формат токена Fernet: версия (1 байт) | время (8 байт) | IV (16 байт) | шифротекст | HMAC (32 байта)
+FERNET_VERSION = b"\x80"
+IV_SIZE = 16
+HMAC_SIZE = 32
+# Минимальная длина: заголовок, один блок AES и подпись
+MIN_TOKEN_SIZE = 1 + 8 + IV_SIZE + 16 + HMAC_SIZE
+
+
+class FastFernet:
+    """Fernet (AES-128-CBC + HMAC-SHA256) с подготовленными ключами.
+
+    Токены побитово совместимы с cryptography.fernet.Fernet: ключ разбирается
+    и объект AES создаётся один раз, а контекст HMAC на каждое сообщение
+    копируется из готового шаблона.
+    """
+
+    def __init__(self, key: Union[bytes, str]):
+        try:
+            raw_key = base64.urlsafe_b64decode(key)
+        except binascii.Error as exc:
+            raise ValueError("Fernet key must be 32 url-safe base64-encoded bytes.") from exc
+        if len(raw_key) != 32:
+            raise ValueError("Fernet key must be 32 url-safe base64-encoded bytes.")
+
+        # По спецификации Fernet: первые 16 байт - ключ подписи, последние 16 - ключ шифрования
+        self._hmac_template = hmac.HMAC(raw_key[:16], hashes.SHA256())
+        self._algorithm = algorithms.AES(raw_key[16:])
+
+    def encrypt(self, data: bytes) -> bytes:
+        iv = os.urandom(IV_SIZE)
+
+        padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        padded_data = padder.update(data) + padder.finalize()
+        encryptor = Cipher(self._algorithm, modes.CBC(iv)).encryptor()
+        ciphertext = encryptor.update(padded_data) + encryptor.finalize()
+
+        basic_parts = FERNET_VERSION + struct.pack(">Q", int(time.time())) + iv + ciphertext
+        h = self._hmac_template.copy()
+        h.update(basic_parts)
+        return base64.urlsafe_b64encode(basic_parts + h.finalize())
+
+    def decrypt(self, token: Union[bytes, str]) -> bytes:
+        try:
+            data = base64.urlsafe_b64decode(token)
+        except (TypeError, binascii.Error):
+            raise InvalidToken
+        if len(data) < MIN_TOKEN_SIZE or data[:1] != FERNET_VERSION:
+            raise InvalidToken
+
+        h = self._hmac_template.copy()
+        h.update(data[:-HMAC_SIZE])
+        try:
+            h.verify(data[-HMAC_SIZE:])
+        except InvalidSignature:
+            raise InvalidToken
+
+        iv = data[9:9 + IV_SIZE]
+        ciphertext = data[9 + IV_SIZE:-HMAC_SIZE]
+        decryptor = Cipher(self._algorithm, modes.CBC(iv)).decryptor()
+        padded_data = decryptor.update(ciphertext)
+        try:
+            padded_data += decryptor.finalize()
+        except ValueError:
+            raise InvalidToken
+
+        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        try:
+            return unpadder.update(padded_data) + unpadder.finalize()
+        except ValueError:
+            raise InvalidToken
@@ -0,0 +1,174 @@
+# Горячий путь сообщений: шифрование, расшифровка и сборка кадров рассылки.
+# Модуль полностью аннотирован и может быть скомпилирован mypyc. Собирать из
+# подкаталога: mypyc запускает setuptools, а тот не принимает pyproject.toml проекта
+#     mkdir -p build && (cd build && mypyc ../hot.py) && cp build/hot.*.so .
+# Собранный hot.*.so (hot.*.pyd на Windows) импортируется вместо hot.py автоматически
+# и в git не попадает. После правки hot.py его нужно пересобрать или удалить,
+# иначе продолжит работать старый код. Без сборки модуль работает как обычный Python
+import base64
+import datetime
+import hashlib
+import hmac
+import os
+import secrets
+from functools import cache, lru_cache
+from typing import Any, List, Optional, Union
+
+import orjson
+
+# rfernet - реализация Fernet на Rust, в разы быстрее на коротких сообщениях.
+# Формат токенов тот же, поэтому при его отсутствии работаем через FastFernet
+# (cryptography с заранее подготовленными ключами AES и HMAC)
+try:
+    import rfernet
+
+    RFERNET_AVAILABLE = True
+except ImportError:
+    RFERNET_AVAILABLE = False
+
+from fast_fernet import FastFernet
+
+
+# Кэш выведенного ключа на диске - только по явному запросу (ENCRYPTION_KEY_CACHE=1)
+# для локальной разработки без ENCRYPTION_KEY: PBKDF2 на 100 000 итераций
+# не пересчитывается при каждом перезапуске. В production задавай ENCRYPTION_KEY
+KEY_CACHE_ENABLED = os.getenv("ENCRYPTION_KEY_CACHE", "").lower() in ("1", "true", "yes")
+KEY_CACHE_DIR = os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "hi-messenger"
+)
+
+
+def _derive_key(secret: str, salt: bytes) -> bytes:
+    raw_key = hashlib.pbkdf2_hmac('sha256', secret.encode(), salt, 100000, 32)
+    return base64.urlsafe_b64encode(raw_key)
+
+
+def _write_private(path: str, data: bytes, exclusive: bool = False) -> None:
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if exclusive else os.O_TRUNC)
+    fd = os.open(path, flags, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+
+
+def _key_cache_path(secret: str) -> Optional[str]:
+    # Имя файла - HMAC секрета на случайном ключе каталога кэша, а не его быстрый хэш:
+    # по имени нельзя дёшево перебирать JWT_SECRET, не имея доступа к самому каталогу
+    try:
+        os.makedirs(KEY_CACHE_DIR, mode=0o700, exist_ok=True)
+        name_key_path = os.path.join(KEY_CACHE_DIR, "name-key")
+        try:
+            _write_private(name_key_path, secrets.token_bytes(32), exclusive=True)
+        except FileExistsError:
+            pass
+        with open(name_key_path, "rb") as f:
+            name_key = f.read()
+    except OSError:
+        return None
+    if len(name_key) != 32:
+        return None
+    return os.path.join(KEY_CACHE_DIR, hmac.new(name_key, secret.encode(), hashlib.sha256).hexdigest())
+
+
+def _read_cached_key(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            cached_key = f.read().strip()
+        raw_key = base64.urlsafe_b64decode(cached_key)
+    except (OSError, ValueError):
+        return None
+    # Повреждённый файл не должен ронять импорт - такой ключ просто выводим заново
+    if len(raw_key) != 32:
+        return None
+    return cached_key
+
+
+# Генерация ключа шифрования (в production используй переменные окружения)
+@cache
+def generate_encryption_key() -> bytes:
+    env_key = os.getenv("ENCRYPTION_KEY")
+    if env_key:
+        return env_key.encode()
+
+    # Генерируем ключ на основе секрета + соль
+    secret = os.getenv("JWT_SECRET", "default-secret-change-in-production")
+    salt = b"hi-messenger-salt-2024"
+
+    if not KEY_CACHE_ENABLED:
+        return _derive_key(secret, salt)
+
+    cache_path = _key_cache_path(secret)
+    if cache_path is not None:
+        cached_key = _read_cached_key(cache_path)
+        if cached_key is not None:
+            return cached_key
+
+    key = _derive_key(secret, salt)
+    if cache_path is not None:
+        try:
+            _write_private(cache_path, key)
+        except OSError:
+            # Кэш необязателен: без доступа к диску просто выводим ключ каждый раз
+            pass
+    return key
+
+
+# Инициализация шифрования: rfernet принимает ключ строкой
+# и сам возвращает токен строкой, FastFernet работает с байтами
+fernet: Any
+if RFERNET_AVAILABLE:
+    fernet = rfernet.Fernet(generate_encryption_key().decode())
+else:
+    fernet = FastFernet(generate_encryption_key())
+
+
+# Шифрование данных
+def encrypt_data(data: str) -> str:
+    token = fernet.encrypt(data.encode())
+    if RFERNET_AVAILABLE:
+        return token
+    return token.decode()
+
+
+# Дешифрование данных (оба бэкенда принимают токен строкой)
+def decrypt_data(encrypted_data: str) -> str:
+    decrypted_data: bytes = fernet.decrypt(encrypted_data)
+    return decrypted_data.decode()
+
+
+# Fernet-токен случаен для каждого шифрования, поэтому одинаковый шифротекст
+# всегда соответствует одному и тому же тексту - расшифровку можно кэшировать
+@lru_cache(maxsize=4096)
+def decrypt_cached(encrypted_data: str) -> str:
+    return decrypt_data(encrypted_data)
+
+
+# Расшифровка пачки сообщений целиком - вызывается через asyncio.to_thread,
+# чтобы расшифровка истории не блокировала event loop
+def decrypt_batch(encrypted_texts: List[str]) -> List[str]:
+    texts: List[str] = []
+    for encrypted_text in encrypted_texts:
+        try:
+            texts.append(decrypt_cached(encrypted_text))
+        except Exception:
+            texts.append("Не удалось расшифровать сообщение")
+    return texts
+
+
+# Рассылаемое сообщение имеет фиксированную форму: префикс с отправителем
+# собирается один раз, а на каждое сообщение сериализуются только изменяемые поля
+def build_message_prefix(user_id: int, username: str) -> bytes:
+    return b"".join((
+        b'{"type":"message","from":', orjson.dumps(user_id),
+        b',"from_username":', orjson.dumps(username),
+        b',"text":'
+    ))
+
+
+def build_message_frame(prefix: bytes, text: str, timestamp: datetime.datetime, message_id: Union[int, float]) -> bytes:
+    return b"".join((
+        prefix, orjson.dumps(text),
+        b',"timestamp":', orjson.dumps(timestamp),
+        b',"message_id":', orjson.dumps(message_id),
+        b"}"
+    ))
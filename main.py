@@ -1,51 +1,24 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from contextlib import asynccontextmanager
 import asyncio
-import json
+import orjson
 import datetime
-from typing import Dict, Any, List, Optional
-import os
-from cryptography.fernet import Fernet
-import base64
-import hashlib
+import time
+from typing import Dict, Any, List, Optional, Set, Tuple
 
-
-# Генерация ключа шифрования (в production используй переменные окружения)
-def generate_encryption_key():
-    key = os.getenv("ENCRYPTION_KEY")
-    if not key:
-        # Генерируем ключ на основе секрета + соль
-        secret = os.getenv("JWT_SECRET", "default-secret-change-in-production")
-        salt = b"hi-messenger-salt-2024"
-        key = hashlib.pbkdf2_hmac('sha256', secret.encode(), salt, 100000, 32)
-        return base64.urlsafe_b64encode(key)
-    return key.encode()
-
-
-# Инициализация шифрования
-fernet = Fernet(generate_encryption_key())
-
-
-# Шифрование данных
-def encrypt_data(data: str) -> str:
-    encrypted_data = fernet.encrypt(data.encode())
-    return encrypted_data.decode()
-
-
-# Дешифрование данных
-def decrypt_data(encrypted_data: str) -> str:
-    decrypted_data = fernet.decrypt(encrypted_data.encode())
-    return decrypted_data.decode()
+# Шифрование и сборка сообщений вынесены в hot.py (можно собрать через mypyc)
+from hot import encrypt_data, decrypt_cached, decrypt_batch, build_message_prefix, build_message_frame
 
 
 # Импорты для базы данных
 try:
     from database import engine, get_db, AsyncSessionLocal
-    from models import Base
+    from models import Base, User, Message
+    from sqlalchemy import insert, update
     from sqlalchemy.ext.asyncio import AsyncSession
     from sqlalchemy.future import select
     from sqlalchemy.orm import selectinload
@@ -59,6 +32,13 @@ except Exception as e:
     DB_AVAILABLE = False
 
 
+# create_all не добавляет новые индексы в уже существующие таблицы
+def create_missing_indexes(connection):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
 # Асинхронная функция для создания таблиц при старте
 async def create_tables():
     if not DB_AVAILABLE:
@@ -68,6 +48,7 @@ async def create_tables():
     try:
         async with engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(create_missing_indexes)
         print("Таблицы в БД созданы/проверены")
     except Exception as e:
         print(f"Error creating tables: {e}")
@@ -78,13 +59,38 @@ async def create_tables():
 async def lifespan(app: FastAPI):
     # Запускается при старте приложения
     await create_tables()
+    background_tasks = []
+    if DB_AVAILABLE:
+        background_tasks = [
+            asyncio.create_task(manager.run_message_writer()),
+            asyncio.create_task(manager.run_last_seen_flusher()),
+        ]
     yield
     # Запускается при остановке приложения
     if DB_AVAILABLE:
+        for task in background_tasks:
+            task.cancel()
+        # Дожидаемся остановки задач: начатая запись пачки завершится,
+        # а финальный сброс ниже сохранит то, что ещё не попало в пачку
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        await manager.flush_messages()
+        await manager.flush_last_seen()
         await engine.dispose()
 
 
-app = FastAPI(lifespan=lifespan)
+# REST-ответы сериализуем через orjson, как и сообщения WebSocket
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Как часто сбрасывать накопленные обновления last_seen в БД (секунды)
+LAST_SEEN_FLUSH_INTERVAL = 5
+# Сколько ждать попутных сообщений перед записью пачки в БД (секунды)
+MESSAGE_BATCH_DELAY = 0.01
+# Сколько ждать отправки одному клиенту, прежде чем счесть его медленным (секунды)
+SEND_TIMEOUT = 5
+# Сколько исходящих сообщений может ждать отправки клиенту, который перестал читать
+SEND_QUEUE_SIZE = 100
+# Через сколько секунд незавершённой отправки клиент считается зависшим
+SEND_STALL_TIME = 1
 
 # Включи CORS для работы с фронтендом
 app.add_middleware(
@@ -101,87 +107,260 @@ class ConnectionManager:
     def __init__(self):
         # Словарь для хранения подключений: {user_id: websocket}
         self.active_connections: Dict[int, WebSocket] = {}
-
-    async def connect(self, websocket: WebSocket, user_id: int):
+        # Очередь исходящих сообщений и задача отправки для каждого клиента
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._writers: Dict[int, asyncio.Task] = {}
+        # Неизменяемый снимок очередей для рассылки: пересобирается при connect/disconnect
+        # и подменяется целиком, поэтому broadcast не видит изменений словаря
+        self._outboxes: Tuple[Tuple[int, asyncio.Queue], ...] = ()
+        # Когда началась текущая отправка клиенту (None - writer не занят отправкой).
+        # По ней отличаем зависшего клиента от writer'а, который просто ещё не успел
+        # запуститься после пачки сообщений
+        self._sending_since: Dict[int, Optional[float]] = {}
+        # Имена подключённых пользователей: читаются из БД один раз при подключении
+        # и меняются только через профиль, поэтому на каждое сообщение в БД не ходим
+        self._usernames: Dict[int, str] = {}
+        # Готовые JSON-префиксы рассылки для каждого отправителя
+        self._message_prefixes: Dict[int, bytes] = {}
+        # Пользователи, чей last_seen нужно обновить при следующем сбросе
+        self._last_seen_dirty: Set[int] = set()
+        # Сообщения, ожидающие записи в БД, и future, в который вернётся их id
+        self._pending_messages: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        # Сигнал для фоновой записи. Создаётся в run_message_writer, то есть в цикле
+        # событий приложения, а не при импорте: None значит, что запись не запущена
+        self._pending_event: Optional[asyncio.Event] = None
+
+    def _rebuild_snapshot(self):
+        self._outboxes = tuple(self._queues.items())
+
+    async def connect(self, websocket: WebSocket, user_id: int, username: str):
         await websocket.accept()
+        # Повторное подключение того же пользователя вытесняет предыдущее
+        old_writer = self._writers.pop(user_id, None)
+        if old_writer is not None:
+            old_writer.cancel()
+
+        # Очередь без жёсткого предела: лишнее отбрасывает _enqueue, и только у зависших клиентов
+        queue = asyncio.Queue()
+        self._sending_since[user_id] = None
         self.active_connections[user_id] = websocket
+        self._queues[user_id] = queue
+        self._writers[user_id] = asyncio.create_task(self._writer(user_id, websocket, queue))
+        self._rebuild_snapshot()
+        self._usernames[user_id] = username
+        self._message_prefixes.pop(user_id, None)
         print(f"User #{user_id} connected. Active connections: {len(self.active_connections)}")
 
-    def disconnect(self, user_id: int):
+    def disconnect(self, user_id: int, websocket: Optional[WebSocket] = None):
+        # Если передан websocket, не трогаем более новое подключение того же пользователя
+        if websocket is not None and self.active_connections.get(user_id) is not websocket:
+            return
+
         if user_id in self.active_connections:
             del self.active_connections[user_id]
+            del self._queues[user_id]
+            writer = self._writers.pop(user_id)
+            if writer is not asyncio.current_task():
+                writer.cancel()
+            self._rebuild_snapshot()
+            self._sending_since.pop(user_id, None)
+            self._usernames.pop(user_id, None)
+            self._message_prefixes.pop(user_id, None)
         print(f"User #{user_id} disconnected. Active connections: {len(self.active_connections)}")
 
-    async def send_personal_message(self, message: str, user_id: int):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_text(message)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections.values():
-            await connection.send_text(message)
-
-
-# Создаем экземпляр менеджера
-manager = ConnectionManager()
-
-# JWT Authentication
-from datetime import datetime, timedelta
-import jwt
-from passlib.context import CryptContext
-
-# Настройки безопасности
-SECRET_KEY = os.getenv("JWT_SECRET", "your-super-secret-jwt-key-change-in-production")
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_DAYS = 30
-security = HTTPBearer()
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    def get_username(self, user_id: int, default: str) -> str:
+        return self._usernames.get(user_id, default)
+
+    def update_username(self, user_id: int, username: str):
+        if user_id in self._usernames:
+            self._usernames[user_id] = username
+        self._message_prefixes.pop(user_id, None)
+
+    def get_message_prefix(self, user_id: int, username: str) -> bytes:
+        prefix = self._message_prefixes.get(user_id)
+        if prefix is None:
+            prefix = build_message_prefix(user_id, username)
+            if user_id in self.active_connections:
+                self._message_prefixes[user_id] = prefix
+        return prefix
+
+    def touch(self, user_id: int):
+        self._last_seen_dirty.add(user_id)
+
+    async def flush_last_seen(self):
+        if not self._last_seen_dirty:
+            return
+
+        user_ids, self._last_seen_dirty = self._last_seen_dirty, set()
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(User)
+                    .where(User.id.in_(user_ids))
+                    .values(last_seen=datetime.datetime.utcnow())
+                )
+                await db.commit()
+        except Exception:
+            # Не теряем обновления: попробуем снова при следующем сбросе
+            self._last_seen_dirty |= user_ids
+            raise
 
+    async def run_last_seen_flusher(self, interval: float = LAST_SEEN_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_last_seen()
+            except Exception as e:
+                print(f"Error updating last_seen: {e}")
+
+    async def save_message(self, sender_id: int, text: str, timestamp: datetime.datetime) -> int:
+        # Сообщение попадает в общую пачку: один INSERT и один коммит на все сообщения,
+        # пришедшие за MESSAGE_BATCH_DELAY. Возвращает id после записи в БД
+        if self._pending_event is None:
+            # Без фоновой записи future никто не завершит - не ждём его вечно
+            raise RuntimeError("Message writer is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending_messages.append(({
+            "text": text,
+            "sender_id": sender_id,
+            "timestamp": timestamp
+        }, future))
+        self._pending_event.set()
+        return await future
+
+    async def flush_messages(self):
+        if not self._pending_messages:
+            return
+
+        batch, self._pending_messages = self._pending_messages, []
+        # Запись пачки не прерывается отменой: после commit повторять её нельзя
+        # (появятся дубли), а во время commit его исход неизвестен. Поэтому при отмене
+        # (остановка приложения) дожидаемся окончания записи и только потом выходим
+        write = asyncio.ensure_future(self._write_batch(batch))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            await asyncio.wait((write,))
+            raise
+
+    async def _write_batch(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        try:
+            message_ids = await self._insert_messages([values for values, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                _, future = batch[0]
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                # Пачка отклонена целиком (например, внешний ключ одной строки) -
+                # пишем строки по одной, чтобы ошибка одного сообщения не задела остальные
+                await self._insert_messages_one_by_one(batch)
+            return
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+        for (_, future), message_id in zip(batch, message_ids):
+            if not future.done():
+                future.set_result(message_id)
 
+    async def _insert_messages(self, rows: List[Dict[str, Any]]) -> List[int]:
+        async with AsyncSessionLocal() as db:
+            # executemany с RETURNING: id приходят в том же порядке, что и строки
+            result = await db.execute(
+                insert(Message).returning(Message.id, sort_by_parameter_order=True),
+                rows
+            )
+            message_ids = list(result.scalars().all())
+            await db.commit()
+        return message_ids
 
-def create_access_token(user_id: int, username: str):
-    expires_delta = timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
-    expire = datetime.utcnow() + expires_delta
+    async def _insert_messages_one_by_one(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        for values, future in batch:
+            try:
+                message_id, = await self._insert_messages([values])
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(message_id)
+
+    async def run_message_writer(self, delay: float = MESSAGE_BATCH_DELAY):
+        self._pending_event = event = asyncio.Event()
+        if self._pending_messages:
+            event.set()
+        try:
+            while True:
+                await event.wait()
+                await asyncio.sleep(delay)
+                event.clear()
+                await self.flush_messages()
+        finally:
+            self._pending_event = None
+
+    async def _writer(self, user_id: int, websocket: WebSocket, queue: asyncio.Queue):
+        # У каждого клиента своя задача отправки: медленный получатель
+        # копит отставание только в своей очереди и не задерживает остальных
+        try:
+            while True:
+                frame = await queue.get()
+                self._sending_since[user_id] = time.monotonic()
+                await asyncio.wait_for(websocket.send(frame), SEND_TIMEOUT)
+                self._sending_since[user_id] = None
+        except asyncio.TimeoutError:
+            # Клиент не успевает читать - закрываем соединение
+            self.disconnect(user_id, websocket)
+            try:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            except Exception:
+                pass
+        except Exception:
+            self.disconnect(user_id, websocket)
+
+    def _enqueue(self, user_id: int, queue: asyncio.Queue, frame: Dict[str, Any]):
+        if queue.qsize() >= SEND_QUEUE_SIZE:
+            # Очередь растёт и у быстрых клиентов, если пачка сообщений разослана раньше,
+            # чем запустились writer'ы. Старое выбрасываем, только если отправка зависла
+            sending_since = self._sending_since.get(user_id)
+            if sending_since is not None and time.monotonic() - sending_since > SEND_STALL_TIME:
+                while queue.qsize() >= SEND_QUEUE_SIZE:
+                    queue.get_nowait()
+        queue.put_nowait(frame)
+
+    def send_personal_message(self, message: bytes, user_id: int):
+        queue = self._queues.get(user_id)
+        if queue is not None:
+            self._enqueue(user_id, queue, {"type": "websocket.send", "bytes": message})
+
+    def broadcast(self, message: bytes):
+        # Сообщение уже закодировано в UTF-8 один раз, клиентам уходят готовые байты.
+        # ASGI-сообщение тоже одно на всех: в очереди кладётся ссылка на него
+        frame = {"type": "websocket.send", "bytes": message}
+        for user_id, queue in self._outboxes:
+            self._enqueue(user_id, queue, frame)
 
-    to_encode = {
-        "sub": str(user_id),
-        "username": username,
-        "exp": expire,
-        "type": "access"
-    }
 
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+# Создаем экземпляр менеджера
+manager = ConnectionManager()
 
+# JWT Authentication
+from auth import averify_password, aget_password_hash, create_access_token, verify_token
 
-def verify_token(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except jwt.PyJWTError:
-        return None
+security = HTTPBearer()
 
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     payload = verify_token(token)
 
-    if not payload or payload.get("type") != "access":
+    if not payload:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired token",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    user_id = int(payload.get("sub"))
-    username = payload.get("username")
+    user_id = int(payload["sub"])
+    username = payload["username"]
 
     return {"id": user_id, "username": username}
 
@@ -213,9 +392,6 @@ async def register_user(request: Request):
                 detail="Password must be at least 6 characters long"
             )
 
-        from database import AsyncSessionLocal
-        from models import User
-
         async with AsyncSessionLocal() as db:
             # Проверяем существование пользователя
             existing_user = await db.execute(
@@ -231,23 +407,25 @@ async def register_user(request: Request):
             encrypted_email = encrypt_data(email) if email else None
 
             # Создаем нового пользователя
-            hashed_password = get_password_hash(password)
+            # Временные метки задаём сами, а id возвращается через INSERT ... RETURNING
+            # при flush - повторный SELECT (refresh) после commit не нужен
+            hashed_password = await aget_password_hash(password)
+            now = datetime.datetime.utcnow()
             new_user = User(
                 username=username,
                 password_hash=hashed_password,
                 email=encrypted_email,
-                created_at=datetime.datetime.utcnow(),
-                last_seen=datetime.datetime.utcnow()
+                created_at=now,
+                last_seen=now
             )
 
             db.add(new_user)
             await db.commit()
-            await db.refresh(new_user)
 
             # Создаем JWT токен
             access_token = create_access_token(new_user.id, new_user.username)
 
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=status.HTTP_201_CREATED,
                 content={
                     "message": "User created successfully",
@@ -281,23 +459,27 @@ async def login_user(request: Request):
                 detail="Username and password are required"
             )
 
-        from database import AsyncSessionLocal
-        from models import User
-
         async with AsyncSessionLocal() as db:
-            # Ищем пользователя
-            result = await db.execute(select(User).filter(User.username == username))
-            user = result.scalar_one_or_none()
+            # Ищем пользователя: нужны только id, имя и хэш пароля
+            result = await db.execute(
+                select(User.id, User.username, User.password_hash)
+                .where(User.username == username)
+            )
+            user = result.one_or_none()
 
-            if not user or not verify_password(password, user.password_hash):
+            if not user or not await averify_password(password, user.password_hash):
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="Invalid credentials",
                     headers={"WWW-Authenticate": "Bearer"},
                 )
 
-            # Обновляем last_seen
-            user.last_seen = datetime.datetime.utcnow()
+            # Обновляем last_seen прямым UPDATE, без загрузки объекта и flush ORM
+            await db.execute(
+                update(User)
+                .where(User.id == user.id)
+                .values(last_seen=datetime.datetime.utcnow())
+            )
             await db.commit()
 
             # Создаем JWT токен
@@ -331,91 +513,121 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 async def websocket_endpoint(websocket: WebSocket, token: str):
     # Проверяем токен
     payload = verify_token(token)
-    if not payload or payload.get("type") != "access":
+    if not payload:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
-    user_id = int(payload.get("sub"))
-    username = payload.get("username")
+    user_id = int(payload["sub"])
+    username = payload["username"]
 
-    await manager.connect(websocket, user_id)
+    if DB_AVAILABLE:
+        # Одна проверка на подключение: пользователь должен существовать, а имя берём
+        # из БД - claim username в токене устаревает после смены имени в профиле
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(select(User.username).where(User.id == user_id))
+                db_username = result.scalar_one_or_none()
+        except Exception as e:
+            # БД недоступна - не обрываем подключение, остаёмся на имени из токена.
+            # Ошибки записи сообщений клиент получит как "Error saving message"
+            print(f"Database error: {e}")
+        else:
+            if db_username is None:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+            username = db_username
+
+    # Срок действия токена запоминаем один раз: в цикле достаточно сравнить время,
+    # без повторной проверки подписи на каждое сообщение
+    token_exp = payload["exp"]
+
+    async def close_expired():
+        manager.disconnect(user_id, websocket)
+        try:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        except Exception:
+            # Сокет мог уже закрыть writer (медленный клиент)
+            pass
+
+    async def expiry_watchdog():
+        # Один таймер на подключение: клиент, который только читает рассылку,
+        # тоже отключается вовремя, а приём сообщений остаётся простым await
+        await asyncio.sleep(max(0, token_exp - time.time()))
+        await close_expired()
+
+    await manager.connect(websocket, user_id, username)
+    watchdog = asyncio.create_task(expiry_watchdog())
 
     try:
         while True:
             # Ждем данные от клиента
             data = await websocket.receive_text()
-            message_data = json.loads(data)
+
+            # Токен истёк во время сессии - соединение не должно его пережить
+            if time.time() > token_exp:
+                await close_expired()
+                break
+
+            message_data = orjson.loads(data)
+
+            # Одна отметка времени на сообщение: для записи в БД и рассылки.
+            # Колонки в БД хранят UTC без часового пояса, поэтому tzinfo отбрасываем
+            now_utc = datetime.datetime.now(datetime.timezone.utc)
+            now = now_utc.replace(tzinfo=None)
 
             # Шифруем текст сообщения перед сохранением
             encrypted_text = encrypt_data(message_data.get("text", ""))
 
+            # Имя на момент подключения, либо обновлённое через профиль
+            sender_username = manager.get_username(user_id, username)
+
             # Эмуляция работы с БД если БД недоступна
             if not DB_AVAILABLE:
-                broadcast_message = json.dumps({
-                    "type": "message",
-                    "from": user_id,
-                    "from_username": username,
-                    "text": message_data.get("text", ""),
-                    "timestamp": datetime.datetime.utcnow().isoformat(),
-                    "message_id": datetime.datetime.now().timestamp()
-                })
-                await manager.broadcast(broadcast_message)
+                broadcast_message = build_message_frame(
+                    manager.get_message_prefix(user_id, sender_username),
+                    message_data.get("text", ""),
+                    now,
+                    now_utc.timestamp()
+                )
+                manager.broadcast(broadcast_message)
                 continue
 
             # Реальная работа с БД
             try:
-                from database import AsyncSessionLocal
-                from models import User, Message
-
-                async with AsyncSessionLocal() as db:
-                    # Проверяем существование пользователя
-                    user_result = await db.execute(select(User).filter(User.id == user_id))
-                    user = user_result.scalar_one_or_none()
-
-                    if not user:
-                        await websocket.send_text(json.dumps({
-                            "type": "error",
-                            "message": "User not found"
-                        }))
-                        continue
-
-                    # Создаем и сохраняем зашифрованное сообщение
-                    new_message = Message(
-                        text=encrypted_text,  # Сохраняем зашифрованный текст
-                        sender_id=user_id,
-                        timestamp=datetime.datetime.utcnow()
-                    )
-                    db.add(new_message)
-                    await db.commit()
-                    await db.refresh(new_message)
-
-                    # Отправляем расшифрованное сообщение всем
-                    broadcast_message = json.dumps({
-                        "type": "message",
-                        "from": user_id,
-                        "from_username": user.username,
-                        "text": message_data.get("text", ""),  # Отправляем оригинальный текст
-                        "timestamp": new_message.timestamp.isoformat(),
-                        "message_id": new_message.id
-                    })
-
-                    await manager.broadcast(broadcast_message)
+                # Сохраняем зашифрованное сообщение вместе с остальными из текущей пачки
+                message_id = await manager.save_message(user_id, encrypted_text, now)
+
+                # last_seen обновится пачкой в фоновой задаче
+                manager.touch(user_id)
+
+                # Отправляем расшифрованное сообщение всем
+                broadcast_message = build_message_frame(
+                    manager.get_message_prefix(user_id, sender_username),
+                    message_data.get("text", ""),  # Отправляем оригинальный текст
+                    now,
+                    message_id
+                )
+
+                manager.broadcast(broadcast_message)
 
             except Exception as e:
                 print(f"Database error: {e}")
-                await websocket.send_text(json.dumps({
+                manager.send_personal_message(orjson.dumps({
                     "type": "error",
                     "message": "Error saving message"
-                }))
+                }), user_id)
 
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
-        disconnect_message = json.dumps({
+        pass
+    finally:
+        watchdog.cancel()
+        manager.disconnect(user_id, websocket)
+        disconnect_message = orjson.dumps({
             "type": "user_disconnected",
             "user_id": user_id,
             "username": username
         })
-        await manager.broadcast(disconnect_message)
+        manager.broadcast(disconnect_message)
 
 
 # API для получения истории сообщений (с расшифровкой)
@@ -425,34 +637,38 @@ async def get_messages(limit: int = 100, current_user: dict = Depends(get_curren
         return {"messages": []}
 
     try:
-        from database import AsyncSessionLocal
-        from models import Message, User
-
         async with AsyncSessionLocal() as db:
-            result = await db.execute(
-                select(Message, User.username)
-                .join(User, Message.sender_id == User.id)
-                .order_by(Message.timestamp.desc())
+            # Последние limit сообщений берём по индексу timestamp DESC во вложенном запросе,
+            # а внешний запрос присоединяет имена и сразу отдаёт их в хронологическом порядке.
+            # При равных отметках времени (грубые часы на Windows) порядок в обоих запросах задаёт id
+            latest = (
+                select(Message.id, Message.text, Message.sender_id, Message.timestamp)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
                 .limit(limit)
+                .subquery()
             )
+            # Выбираем только нужные колонки: строки приходят кортежами, без ORM-объектов
+            result = await db.execute(
+                select(latest.c.id, latest.c.text, latest.c.sender_id, latest.c.timestamp, User.username)
+                .join(User, latest.c.sender_id == User.id)
+                .order_by(latest.c.timestamp.asc(), latest.c.id.asc())
+            )
+            rows = result.all()
 
-            messages = []
-            for message, username in result:
-                try:
-                    # Расшифровываем текст сообщения
-                    decrypted_text = decrypt_data(message.text)
-                except:
-                    decrypted_text = "Не удалось расшифровать сообщение"
+        # Расшифровываем все тексты за один переход в рабочий поток
+        decrypted_texts = await asyncio.to_thread(decrypt_batch, [row.text for row in rows])
 
-                messages.append({
-                    "id": message.id,
-                    "text": decrypted_text,
-                    "from": message.sender_id,
-                    "from_username": username,
-                    "timestamp": message.timestamp.isoformat()
-                })
+        messages = []
+        for (message_id, _, sender_id, timestamp, username), decrypted_text in zip(rows, decrypted_texts):
+            messages.append({
+                "id": message_id,
+                "text": decrypted_text,
+                "from": sender_id,
+                "from_username": username,
+                "timestamp": timestamp.isoformat()
+            })
 
-            return {"messages": list(reversed(messages))}
+        return {"messages": messages}
 
     except Exception as e:
         print(f"Error getting messages: {e}")
@@ -466,9 +682,6 @@ async def get_user_info(user_id: int, current_user: dict = Depends(get_current_u
         return {"id": user_id, "username": f"User_{user_id}", "status": "offline"}
 
     try:
-        from database import AsyncSessionLocal
-        from models import User
-
         async with AsyncSessionLocal() as db:
             result = await db.execute(select(User).filter(User.id == user_id))
             user = result.scalar_one_or_none()
@@ -478,7 +691,7 @@ async def get_user_info(user_id: int, current_user: dict = Depends(get_current_u
                 decrypted_email = None
                 if user.email:
                     try:
-                        decrypted_email = decrypt_data(user.email)
+                        decrypted_email = decrypt_cached(user.email)
                     except:
                         decrypted_email = "Не удалось расшифровать"
 
@@ -510,9 +723,6 @@ async def update_user_profile(request: Request, current_user: dict = Depends(get
         if len(new_username) < 3:
             raise HTTPException(status_code=400, detail="Username must be at least 3 characters long")
 
-        from database import AsyncSessionLocal
-        from models import User
-
         async with AsyncSessionLocal() as db:
             # Проверяем, не занят ли username
             existing_user = await db.execute(
@@ -531,6 +741,7 @@ async def update_user_profile(request: Request, current_user: dict = Depends(get
                     user.email = encrypt_data(email)
                 user.last_seen = datetime.datetime.utcnow()
                 await db.commit()
+                manager.update_username(user.id, user.username)
 
                 # Создаем новый токен с обновленным username
                 access_token = create_access_token(user.id, user.username)
@@ -590,6 +801,15 @@ async def serve_spa(full_path: str):
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
 
-    uvicorn.run("main:app", host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvloop + httptools вместо стандартного asyncio-цикла (uvloop не работает на Windows)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets"
+    )
\ No newline at end of file
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import ForeignKey, Text, DateTime, String
+from sqlalchemy import ForeignKey, Text, DateTime, String, Index
 import datetime
 import secrets
 
@@ -18,10 +18,12 @@ class User(Base):
     created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow)
     last_seen: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow)
 
+    # Связи не подгружаются лениво: в async-сессии это скрытый запрос на каждый объект (N+1),
+    # поэтому нужные связи загружаются явно через selectinload/joinedload
     # Связь с сообщениями
-    messages = relationship("Message", back_populates="sender")
+    messages = relationship("Message", back_populates="sender", lazy="raise")
     # Связь с сессиями
-    sessions = relationship("UserSession", back_populates="user")
+    sessions = relationship("UserSession", back_populates="user", lazy="raise")
 
 
 class UserSession(Base):
@@ -35,7 +37,7 @@ class UserSession(Base):
     user_agent: Mapped[str] = mapped_column(Text, nullable=True)
 
     # Связь с пользователем
-    user = relationship("User", back_populates="sessions")
+    user = relationship("User", back_populates="sessions", lazy="raise")
 
 
 class Message(Base):
@@ -44,7 +46,12 @@ class Message(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     text: Mapped[str] = mapped_column(Text, nullable=False)
     timestamp: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow)
-    sender_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    # Индекс по внешнему ключу: JOIN с users и выборки сообщений пользователя
+    sender_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
 
     # Связь с отправителем
-    sender = relationship("User", back_populates="messages")
\ No newline at end of file
+    sender = relationship("User", back_populates="messages", lazy="raise")
+
+
+# История сообщений читается как ORDER BY timestamp DESC LIMIT N
+Index("ix_messages_timestamp_desc", Message.timestamp.desc())